@@ -4,15 +4,49 @@ import numpy as np
 from io import BytesIO
 import warnings
 import xmlrpc.client
+import threading
 from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import os
+import hashlib
+import xlsxwriter
 from dotenv import load_dotenv
+from openpyxl import load_workbook
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+try:
+    import python_calamine
+except ImportError:
+    python_calamine = None
 
 # Load environment variables
 load_dotenv()
 
 warnings.filterwarnings('ignore')
 
+# Column dtypes declared up front so the reader skips type inference; text is Arrow-backed
+INVENTORY_DTYPES = {'lot': 'string[pyarrow]', 'product_name': 'string[pyarrow]', 'vendor': 'string[pyarrow]', 'price_unit': 'float64'}
+ODOO_DTYPES = {'barcode': 'string[pyarrow]', 'product_name': 'string[pyarrow]', 'product_ref': 'string[pyarrow]', 'vendor_name': 'string[pyarrow]', 'Unit_Price': 'float64'}
+
+# Only these columns are parsed from each upload
+INVENTORY_COLUMNS = ['lot', 'product_name', 'vendor', 'price_unit', 'discount']
+ODOO_COLUMNS = ['barcode', 'product_name', 'product_ref', 'vendor_name', 'Unit_Price']
+COMBINED_COLUMNS = ['vendor_name', 'product_name', 'unit_price', 'quantity', 'label', 'discount']
+# Text columns of the combined CSV are read as strings, so labels keep leading zeros
+COMBINED_CSV_DTYPES = {'label': 'string[pyarrow]', 'vendor_name': 'string[pyarrow]', 'product_name': 'string[pyarrow]'}
+
+# Sheet, parsed columns and dtypes for each merger upload
+SHEET_SPECS = {
+    'inventory': ('Processed Returns', INVENTORY_COLUMNS, INVENTORY_DTYPES),
+    'odoo': ('PO_Results', ODOO_COLUMNS, ODOO_DTYPES),
+}
+
+# Rows sent to the browser for the processed-data table
+PREVIEW_ROWS = 1000
+
+# How many credit-note creates run at once
+CREDIT_NOTE_WORKERS = 4
+
 # Set page configuration
 st.set_page_config(
     page_title="Inventory & ODOO Merger",
@@ -137,102 +171,256 @@ def get_odoo_config():
         'hq_company_name': os.getenv('ODOO_COMPANY_NAME', '')
     }
 
+def get_odoo_proxy(config, endpoint):
+    url = '{}/xmlrpc/2/{}'.format(config['url'].rstrip('/'), endpoint)
+    # The stdlib transport keeps its HTTP/1.1 connection alive, so reusing the proxy reuses the connection
+    return xmlrpc.client.ServerProxy(url)
+
+# Per-thread object proxies, so each credit-note worker reuses its own connection
+_worker_proxies = threading.local()
+
+def _get_worker_proxy(config):
+    if getattr(_worker_proxies, 'url', None) != config['url']:
+        _worker_proxies.url = config['url']
+        _worker_proxies.models = get_odoo_proxy(config, 'object')
+    return _worker_proxies.models
+
 def test_odoo_connection(config):
     try:
-        common = xmlrpc.client.ServerProxy(config['url'] + 'xmlrpc/2/common')
+        common = get_odoo_proxy(config, 'common')
         uid = common.authenticate(config['db'], config['username'], config['password'], {})
         if uid:
-            return True, "✅ Connected to Odoo successfully!"
+            return True, "✅ Connected to Odoo successfully!", uid
         else:
-            return False, "❌ Authentication failed"
+            return False, "❌ Authentication failed", None
+    except Exception as e:
+        return False, f"❌ Connection error: {str(e)}", None
+
+def _has_values(row):
+    # Formatted but empty rows come back from openpyxl as all-None
+    return any(value is not None for value in row)
+
+def read_excel_fast(file, sheet_name=None, usecols=None, dtype=None):
+    if python_calamine is not None:
+        # Rust-based calamine parser, much faster than openpyxl
+        return pd.read_excel(file, sheet_name=sheet_name or 0, engine='calamine', usecols=usecols, dtype=dtype)
+
+    # Fallback: stream the sheet with openpyxl's read-only mode instead of building the full workbook DOM
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, ())
+        # Drop blank rows the way pandas' own readers do
+        rows = (row for row in rows if _has_values(row))
+        if usecols:
+            # Keep only the requested cells of each row, in sheet order
+            missing = [col for col in usecols if col not in header]
+            if missing:
+                raise ValueError(f"Usecols do not match columns, columns expected but not found: {missing}")
+            indices = sorted(header.index(col) for col in usecols)
+            header = [header[i] for i in indices]
+            rows = ([row[i] if i < len(row) else None for i in indices] for row in rows)
+        df = pd.DataFrame(rows, columns=header)
+        if dtype:
+            df = df.astype({col: typ for col, typ in dtype.items() if col in df.columns})
+        return df
+    finally:
+        # Release the underlying zip handle
+        wb.close()
+
+@st.cache_data(show_spinner=False)
+def _load_sheet(file_bytes, sheet=None, usecols=None, dtype=None):
+    # Keyed on the raw bytes so Streamlit reruns skip re-parsing the same upload
+    return read_excel_fast(BytesIO(file_bytes), sheet_name=sheet, usecols=usecols, dtype=dtype)
+
+def _require_columns(columns, required):
+    # Report every missing column at once
+    missing = [col for col in required if col not in columns]
+    if missing:
+        raise Exception(f"Missing required column(s): {', '.join(missing)}")
+
+@st.cache_data(show_spinner=False)
+def _read_header(file_bytes, is_csv=False):
+    # Header row only, so columns can be validated before a usecols parse
+    if is_csv:
+        return list(pd.read_csv(BytesIO(file_bytes), nrows=0).columns)
+    wb = load_workbook(BytesIO(file_bytes), read_only=True)
+    try:
+        return list(next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+    finally:
+        wb.close()
+
+@st.cache_data(show_spinner=False)
+def _count_sheet_rows(file_bytes, sheet=None, required=None):
+    # Streamed row count without building a DataFrame. The sheet's dimension record also
+    # covers formatted but empty rows, so blank rows are skipped to match the parsed records
+    wb = load_workbook(BytesIO(file_bytes), read_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, ())
+        if required:
+            _require_columns(header, required)
+        return sum(1 for row in rows if _has_values(row))
+    finally:
+        wb.close()
+
+@st.cache_data(show_spinner=False)
+def _load_csv(file_bytes, usecols=None, dtype=None):
+    return pd.read_csv(BytesIO(file_bytes), usecols=usecols, dtype=dtype)
+
+def load_combined_file(uploaded_file):
+    # The combined file is machine-consumed, so CSV skips the xlsx parse entirely
+    is_csv = uploaded_file.name.lower().endswith('.csv')
+    # Check the header first, since a usecols parse fails on the first missing column
+    _require_columns(_read_header(uploaded_file.getvalue(), is_csv), COMBINED_COLUMNS)
+    if is_csv:
+        return _load_csv(uploaded_file.getvalue(), COMBINED_COLUMNS, COMBINED_CSV_DTYPES)
+    return _load_sheet(uploaded_file.getvalue(), usecols=COMBINED_COLUMNS)
+
+def count_combined_rows(uploaded_file):
+    if uploaded_file.name.lower().endswith('.csv'):
+        return len(load_combined_file(uploaded_file))
+    return _count_sheet_rows(uploaded_file.getvalue(), required=COMBINED_COLUMNS)
+
+def load_single_file(file_bytes, file_type):
+    try:
+        sheet, usecols, dtype = SHEET_SPECS[file_type]
+        return _load_sheet(file_bytes, sheet, usecols, dtype)
     except Exception as e:
-        return False, f"❌ Connection error: {str(e)}"
+        raise Exception(f"Error reading {file_type} file: {str(e)}")
+
+def load_files(inventory_bytes, odoo_bytes):
+    # Parse the provided files concurrently; workers share the script context so st.cache_data works
+    with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+        inventory_future = executor.submit(load_single_file, inventory_bytes, 'inventory') if inventory_bytes else None
+        odoo_future = executor.submit(load_single_file, odoo_bytes, 'odoo') if odoo_bytes else None
+        
+        inventory_df = inventory_future.result() if inventory_future else None
+        odoo_df = odoo_future.result() if odoo_future else None
+    
+    return inventory_df, odoo_df
 
-def process_single_file(file, file_type):
+def _file_digest(file_bytes):
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+def _session_cached(key, file_hash, compute):
+    # Reuse a per-upload result from session state while the upload's content is unchanged
+    if st.session_state.get(f'{key}_hash') != file_hash:
+        st.session_state[key] = compute()
+        st.session_state[f'{key}_hash'] = file_hash
+    return st.session_state[key]
+
+def load_uploaded_files(inventory_bytes, inventory_hash, odoo_bytes, odoo_hash):
+    # Parse each upload once per content hash; unchanged uploads reuse the stored DataFrame
+    inventory_new = inventory_bytes is not None and st.session_state.get('inv_df_hash') != inventory_hash
+    odoo_new = odoo_bytes is not None and st.session_state.get('odoo_df_hash') != odoo_hash
+    
+    inventory_df, odoo_df = load_files(
+        inventory_bytes if inventory_new else None,
+        odoo_bytes if odoo_new else None
+    )
+    if inventory_new:
+        st.session_state['inv_df'] = inventory_df
+        st.session_state['inv_df_hash'] = inventory_hash
+    if odoo_new:
+        st.session_state['odoo_df'] = odoo_df
+        st.session_state['odoo_df_hash'] = odoo_hash
+    
+    return (
+        st.session_state['inv_df'] if inventory_bytes is not None else None,
+        st.session_state['odoo_df'] if odoo_bytes is not None else None
+    )
+
+def process_single_file(df, file_type):
     try:
         if file_type == 'inventory':
-            # Read inventory report - Processed Returns sheet
-            df = pd.read_excel(file, sheet_name='Processed Returns')
-            
-            # Process inventory data
-            processed = df[['lot', 'product_name', 'vendor', 'price_unit', 'discount']].copy()
-            processed['vendor_name'] = processed['vendor']
-            processed['product_name'] = processed['product_name']
-            processed['unit_price'] = processed['price_unit']
-            processed['label'] = processed['lot'].astype(str)
-            processed['source'] = 'inventory'
-            processed['quantity'] = 1  # Set quantity to 1 for all records
-            processed['discount'] = processed['discount'].fillna(0)  # Fill NaN with 0
-            
-            # Select and rename columns for final output
-            final = processed[['vendor_name', 'product_name', 'unit_price', 'label', 'quantity', 'discount', 'source']]
+            # Build the final output in one construction
+            final = pd.DataFrame({
+                'vendor_name': df['vendor'],
+                'product_name': df['product_name'],
+                'unit_price': df['price_unit'].to_numpy(),
+                'label': df['lot'].astype('string[pyarrow]'),
+                'quantity': np.ones(len(df), dtype=np.int8),  # Set quantity to 1 for all records
+                'discount': pd.to_numeric(df['discount'], errors='coerce').fillna(0).to_numpy(),  # Stray text and NaN become 0
+                'source': 'inventory',
+            })
             
         elif file_type == 'odoo':
-            # Read ODOO PO results
-            df = pd.read_excel(file, sheet_name='PO_Results')
-            
-            # Process ODOO data
-            processed = df[['barcode', 'product_name', 'product_ref', 'vendor_name', 'Unit_Price']].copy()
-            processed['label'] = processed['barcode'].astype(str)
-            processed['unit_price'] = processed['Unit_Price']
-            
-            # Set product_name to "LOT SAREES" for ODOO data
-            processed['product_name'] = "LOT SAREES"
-            processed['source'] = 'odoo'
-            processed['quantity'] = 1  # Set quantity to 1 for all records
-            processed['discount'] = 0  # Set discount to 0 for ODOO records
-            
-            # Select and rename columns for final output
-            final = processed[['vendor_name', 'product_name', 'unit_price', 'label', 'quantity', 'discount', 'source']]
+            # Build the final output in one construction
+            final = pd.DataFrame({
+                'vendor_name': df['vendor_name'],
+                'product_name': "LOT SAREES",  # Set product_name to "LOT SAREES" for ODOO data
+                'unit_price': df['Unit_Price'].to_numpy(),
+                'label': df['barcode'].astype('string[pyarrow]'),
+                'quantity': np.ones(len(df), dtype=np.int8),  # Set quantity to 1 for all records
+                'discount': 0.0,  # Set discount to 0 for ODOO records
+                'source': 'odoo',
+            })
         
         return final
         
     except Exception as e:
         raise Exception(f"Error processing {file_type} file: {str(e)}")
 
-def process_files(inventory_file, odoo_file):
+def process_files(inventory_df, odoo_df):
     try:
-        # Initialize empty dataframes with consistent columns
-        inventory_final = pd.DataFrame(columns=['vendor_name', 'product_name', 'unit_price', 'label', 'quantity', 'discount', 'source'])
-        odoo_final = pd.DataFrame(columns=['vendor_name', 'product_name', 'unit_price', 'label', 'quantity', 'discount', 'source'])
-        
-        # Process inventory file if provided
-        if inventory_file:
-            inventory_final = process_single_file(inventory_file, 'inventory')
-        
-        # Process ODOO file if provided
-        if odoo_file:
-            odoo_final = process_single_file(odoo_file, 'odoo')
-        
-        # Combine both datasets if available
-        if not inventory_final.empty and not odoo_final.empty:
-            # Ensure both dataframes have the same columns in the same order
-            final_df = pd.concat([inventory_final, odoo_final], ignore_index=True)
-        elif not inventory_final.empty:
-            final_df = inventory_final
-        elif not odoo_final.empty:
-            final_df = odoo_final
-        else:
+        parts = []
+        
+        # Process inventory data if provided
+        if inventory_df is not None:
+            parts.append(process_single_file(inventory_df, 'inventory'))
+        
+        # Process ODOO data if provided
+        if odoo_df is not None:
+            parts.append(process_single_file(odoo_df, 'odoo'))
+        
+        # Combine the datasets that have records
+        parts = [part for part in parts if not part.empty]
+        if not parts:
             raise Exception("No valid files provided")
+        final_df = parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
         
-        # Ensure discount column is numeric and fill any NaN values with 0
-        final_df['discount'] = pd.to_numeric(final_df['discount'], errors='coerce').fillna(0)
+        # Repetitive text columns are stored as categories
+        for col in ('vendor_name', 'source', 'product_name'):
+            final_df[col] = final_df[col].astype('category')
         
         return final_df
         
     except Exception as e:
         raise Exception(f"Error processing files: {str(e)}")
 
-def process_odoo_integration(uploaded_file, config):
+def write_excel_fast(df, sheet_name):
+    # pandas' ExcelWriter emits cells column by column, which xlsxwriter's constant_memory
+    # mode cannot handle, so rows are streamed to the workbook directly instead
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, list(df.columns))
+    for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        # Missing values become blank cells, one row at a time
+        worksheet.write_row(row_idx, 0, [None if pd.isna(value) else value for value in row])
+    workbook.close()
+    
+    output.seek(0)
+    return output
+
+def _create_credit_note(config, uid, payload):
+    # ServerProxy is not thread-safe, so each worker thread uses its own proxy and connection
+    try:
+        return _get_worker_proxy(config).execute_kw(
+            config['db'], uid, config['password'],
+            'account.move', 'create',
+            [payload]
+        )
+    except Exception as e:
+        return e
+
+def _process_df(df, config, uid, models=None):
     try:
-        # Read the uploaded Excel file
-        df = pd.read_excel(uploaded_file)
-        
         # Check if the required columns exist
-        required_columns = ["vendor_name", "product_name", "unit_price", "quantity", "label", "discount"]
-        for col in required_columns:
-            if col not in df.columns:
-                raise Exception(f"Missing required column: {col}")
+        _require_columns(df.columns, COMBINED_COLUMNS)
         
         # Rename columns to match expected format
         df = df.rename(columns={
@@ -244,10 +432,13 @@ def process_odoo_integration(uploaded_file, config):
             "discount": "Discount"
         })
         
-        # === Odoo XML-RPC Connection ===
-        common = xmlrpc.client.ServerProxy('{}/xmlrpc/2/common'.format(config['url']))
-        uid = common.authenticate(config['db'], config['username'], config['password'], {})
-        models = xmlrpc.client.ServerProxy('{}/xmlrpc/2/object'.format(config['url']))  # Fixed this line
+        # Group on categorical codes rather than Python strings
+        for col in ("Vendor", "Product"):
+            df[col] = df[col].astype("category")
+        
+        # === Odoo XML-RPC Connection (uid comes from the cached login) ===
+        if models is None:
+            models = get_odoo_proxy(config, 'object')
         
         # === Static Values ===
         credit_note_date = date.today().strftime("%Y-%m-%d")
@@ -255,81 +446,142 @@ def process_odoo_integration(uploaded_file, config):
         reference = "Damage"
         
         # === Group rows by Vendor, Product, CostPrice, Discount ===
-        df_grouped = df.groupby(["Vendor", "Product", "CostPrice", "Discount"], as_index=False).agg({
+        # Each lot carries its own separator (missing lots become ""), so one groupby
+        # can concatenate them without a per-group filter or a second pass
+        group_keys = ["Vendor", "Product", "CostPrice", "Discount"]
+        lot_numbers = (df["LotNumber"].astype("string[pyarrow]") + ", ").fillna("")
+        df_grouped = df.assign(LotNumber=lot_numbers).groupby(group_keys, sort=False, as_index=False, observed=True).agg({
             "Quantity": "sum",
-            "LotNumber": lambda x: ", ".join(str(v) for v in x if pd.notna(v))
+            "LotNumber": "".join
         })
+        df_grouped["LotNumber"] = df_grouped["LotNumber"].str.removesuffix(", ")
+        
+        # === Coerce line columns once for the whole frame ===
+        df_grouped["Product"] = df_grouped["Product"].astype(str).str.strip()
+        df_grouped[["Quantity", "CostPrice", "Discount"]] = df_grouped[["Quantity", "CostPrice", "Discount"]].astype(float)
+        df_grouped["LotNumber"] = df_grouped["LotNumber"].astype(str)
         
         results = []
+        if df_grouped.empty:
+            # Nothing to look up or create, so no Odoo call is made
+            results.append("❌ No rows to process.")
+            return results
         
-        # === Process Vendor Groups ===
-        for vendor_name, group in df_grouped.groupby("Vendor"):
-            # === Fetch Vendor ID ===
-            vendor_ids = models.execute_kw(
+        # === Fetch Vendor IDs in one batch ===
+        vendor_names = df_grouped["Vendor"].unique().tolist()
+        vendor_rows = models.execute_kw(
+            config['db'], uid, config['password'],
+            'res.partner', 'search_read',
+            [[['name', 'in', vendor_names]]],
+            {'fields': ['id', 'name']}
+        )
+        vendor_map = {}
+        for r in vendor_rows:
+            vendor_map.setdefault(r['name'], r['id'])
+        
+        # === Fetch Product IDs: exact names in one batch, ilike per remaining unique name ===
+        # Lines of unmatched vendors are skipped below, so only matched vendors' products are searched
+        product_names = df_grouped.loc[df_grouped["Vendor"].isin(list(vendor_map)), "Product"].unique().tolist()
+        product_map = {}
+        if product_names:
+            product_rows = models.execute_kw(
                 config['db'], uid, config['password'],
-                'res.partner', 'search',
-                [[['name', '=', vendor_name]]],
+                'product.product', 'search_read',
+                [[['name', 'in', product_names]]],
+                {'fields': ['id', 'name']}
+            )
+            for r in product_rows:
+                product_map.setdefault(r['name'], r['id'])
+        for product_name in product_names:
+            if product_name in product_map:
+                continue
+            product_ids = models.execute_kw(
+                config['db'], uid, config['password'],
+                'product.product', 'search',
+                [[['name', 'ilike', product_name]]],
                 {'limit': 1}
             )
-            if not vendor_ids:
+            if product_ids:
+                product_map[product_name] = product_ids[0]
+        
+        # === Process Vendor Groups ===
+        credit_notes = []
+        for vendor_name, group in df_grouped.groupby("Vendor", observed=True):
+            vendor_id = vendor_map.get(vendor_name)
+            if vendor_id is None:
                 results.append(f"❌ Vendor '{vendor_name}' not found. Skipping vendor.")
                 continue
-            vendor_id = vendor_ids[0]
 
             # === Build Line Items ===
-            line_vals = []
-            for _, row in group.iterrows():
-                product_name = str(row["Product"]).strip()
-                qty = float(row["Quantity"])
-                price = float(row["CostPrice"])
-                discount = float(row["Discount"])
-                lot_number = str(row["LotNumber"])
-
-                # === Fetch Product ID ===
-                product_ids = models.execute_kw(
-                    config['db'], uid, config['password'],
-                    'product.product', 'search',
-                    [[['name', 'ilike', product_name]]],
-                    {'limit': 1}
-                )
-                if not product_ids:
-                    results.append(f"❌ Product '{product_name}' not found. Skipping this line.")
-                    continue
-                product_id = product_ids[0]
-
-                # === Create Line Value ===
-                line_vals.append((0, 0, {
+            product_ids = group["Product"].map(product_map)
+            found = product_ids.notna()
+            for product_name in group.loc[~found, "Product"].unique():
+                results.append(f"❌ Product '{product_name}' not found. Skipping its lines.")
+            
+            lines = group[found]
+            line_vals = [
+                (0, 0, {
                     'product_id': product_id,
                     'quantity': qty,
                     'price_unit': price,
                     'discount': discount,
-                    'name': f"{product_name} (Lots: {lot_number}) - Discount: {discount}%",
-                }))
+                    'name': (
+                        f"{product_name} (Lots: {lot_number}) - Discount: {discount}%"
+                        if lot_number
+                        else f"{product_name} - Discount: {discount}%"
+                    ),
+                })
+                for product_name, qty, price, discount, lot_number, product_id in zip(
+                    lines["Product"].tolist(),
+                    lines["Quantity"].tolist(),
+                    lines["CostPrice"].tolist(),
+                    lines["Discount"].tolist(),
+                    lines["LotNumber"].tolist(),
+                    product_ids[found].astype(int).tolist(),
+                )
+            ]
 
             if not line_vals:
                 results.append(f"❌ No valid lines for vendor '{vendor_name}'. Skipping.")
                 continue
 
-            # === Create Vendor Credit Note ===
-            credit_note_id = models.execute_kw(
-                config['db'], uid, config['password'],
-                'account.move', 'create',
-                [{
-                    'move_type': 'in_refund',
-                    'partner_id': vendor_id,
-                    'invoice_date': credit_note_date,
-                    'invoice_date_due': due_date,
-                    'ref': reference,
-                    'invoice_line_ids': line_vals,
-                }]
-            )
-            
+            # === Queue Vendor Credit Note ===
+            credit_notes.append((vendor_name, {
+                'move_type': 'in_refund',
+                'partner_id': vendor_id,
+                'invoice_date': credit_note_date,
+                'invoice_date_due': due_date,
+                'ref': reference,
+                'invoice_line_ids': line_vals,
+            }))
+        
+        # === Create Vendor Credit Notes in parallel, one create per vendor ===
+        with ThreadPoolExecutor(max_workers=CREDIT_NOTE_WORKERS) as executor:
+            created = list(executor.map(lambda job: _create_credit_note(config, uid, job[1]), credit_notes))
+        
+        for (vendor_name, _), credit_note_id in zip(credit_notes, created):
+            if isinstance(credit_note_id, xmlrpc.client.Fault):
+                results.append(f"❌ Failed to create Vendor Credit Note for '{vendor_name}': {credit_note_id.faultString}")
+                continue
+            if isinstance(credit_note_id, Exception):
+                results.append(f"❌ Failed to create Vendor Credit Note for '{vendor_name}': {str(credit_note_id)}")
+                continue
             results.append(f"✅ Vendor Credit Note created for '{vendor_name}' with ID: {credit_note_id}")
         
         return results
         
     except Exception as e:
         raise Exception(f"Error processing Odoo integration: {str(e)}")
+
+def process_odoo_integration(uploaded_file, config, uid, models=None):
+    try:
+        # Read the uploaded Excel or CSV file, reusing the parse while its content is unchanged
+        file_hash = _file_digest(uploaded_file.getvalue())
+        df = _session_cached('combined_upload_df', file_hash, lambda: load_combined_file(uploaded_file))
+    except Exception as e:
+        raise Exception(f"Error processing Odoo integration: {str(e)}")
+    
+    return _process_df(df, config, uid, models)
     
 
 def main():
@@ -403,10 +655,15 @@ def main():
                 type=['xlsx'],
                 key='inventory'
             )
+            inventory_bytes = inventory_file.getvalue() if inventory_file else None
+            inventory_hash = _file_digest(inventory_bytes) if inventory_file else None
             if inventory_file:
                 try:
-                    inventory_preview = pd.read_excel(inventory_file, sheet_name='Processed Returns')
-                    st.success(f"✅ Inventory file uploaded! Records: {len(inventory_preview):,}")
+                    inventory_rows = _session_cached(
+                        'inv_rows', inventory_hash,
+                        lambda: _count_sheet_rows(inventory_bytes, 'Processed Returns', INVENTORY_COLUMNS)
+                    )
+                    st.success(f"✅ Inventory file uploaded! Records: {inventory_rows:,}")
                 except Exception as e:
                     st.error(f"❌ Error reading inventory file: {str(e)}")
         
@@ -417,91 +674,140 @@ def main():
                 type=['xlsx'],
                 key='odoo'
             )
+            odoo_bytes = odoo_file.getvalue() if odoo_file else None
+            odoo_hash = _file_digest(odoo_bytes) if odoo_file else None
             if odoo_file:
                 try:
-                    odoo_preview = pd.read_excel(odoo_file, sheet_name='PO_Results')
-                    st.success(f"✅ ODOO file uploaded! Records: {len(odoo_preview):,}")
+                    odoo_rows = _session_cached(
+                        'odoo_rows', odoo_hash,
+                        lambda: _count_sheet_rows(odoo_bytes, 'PO_Results', ODOO_COLUMNS)
+                    )
+                    st.success(f"✅ ODOO file uploaded! Records: {odoo_rows:,}")
                 except Exception as e:
                     st.error(f"❌ Error reading ODOO file: {str(e)}")
         
         # Process button
         if inventory_file or odoo_file:
+            # Only the chosen format is serialized for download
+            export_format = st.radio("📄 Download format", ["xlsx", "csv"], horizontal=True, key="export_format")
+            
+            merger_key = (inventory_hash, odoo_hash)
             if st.button("🚀 Process Files", use_container_width=True, key="process_files"):
                 with st.spinner("🔄 Processing files... Please wait."):
                     try:
-                        # Process files
-                        result_df = process_files(inventory_file, odoo_file)
-                        
-                        # Success message
-                        st.markdown('<div class="success-box">✅ Files processed successfully!</div>', unsafe_allow_html=True)
-                        
-                        # Display results
-                        st.markdown('<div class="sub-header">📊 Processed Data</div>', unsafe_allow_html=True)
-                        
-                        # Show data with pagination
-                        st.dataframe(
-                            result_df,
+                        # Only rebuild the result when the uploaded content changed
+                        if st.session_state.get('merger_key') != merger_key:
+                            # Parse the uploads once and process the DataFrames
+                            inventory_df, odoo_df = load_uploaded_files(inventory_bytes, inventory_hash, odoo_bytes, odoo_hash)
+                            result_df = process_files(inventory_df, odoo_df)
+                            
+                            st.session_state['merger_key'] = merger_key
+                            st.session_state['merger_df'] = result_df
+                            st.session_state['merger_downloads'] = {}
+                            
+                            # Hand the result to the Odoo tab without an Excel round-trip
+                            st.session_state.combined_df = result_df
+                    
+                    except Exception as e:
+                        st.error(f"❌ Error processing files: {str(e)}")
+            
+            # The stored result stays on screen across reruns while the uploads are unchanged
+            if st.session_state.get('merger_key') == merger_key:
+                try:
+                    result_df = st.session_state['merger_df']
+                    
+                    # Success message
+                    st.markdown('<div class="success-box">✅ Files processed successfully!</div>', unsafe_allow_html=True)
+                    
+                    # Display results
+                    st.markdown('<div class="sub-header">📊 Processed Data</div>', unsafe_allow_html=True)
+                    
+                    # Show only the first rows; the full data is in the download
+                    st.dataframe(
+                        result_df.head(PREVIEW_ROWS),
+                        use_container_width=True,
+                        hide_index=True,
+                        height=400
+                    )
+                    if len(result_df) > PREVIEW_ROWS:
+                        st.caption(f"Showing first {PREVIEW_ROWS:,} of {len(result_df):,} rows — download for full data.")
+                    
+                    # Summary statistics
+                    st.markdown('<div class="sub-header">📈 Summary Statistics</div>', unsafe_allow_html=True)
+                    
+                    # Value totals as dot products; missing values count as 0
+                    unit_price = result_df['unit_price'].to_numpy(dtype=float, na_value=0.0)
+                    quantity = result_df['quantity'].to_numpy(dtype=float, na_value=0.0)
+                    discount = result_df['discount'].to_numpy(dtype=float, na_value=0.0)
+                    total_value = float(np.dot(unit_price, quantity))
+                    total_discount = float(np.dot(unit_price * quantity, discount)) / 100.0
+                    net_value = total_value - total_discount
+                    
+                    # Per-source record counts from a single pass
+                    source_counts = result_df['source'].value_counts(sort=False)
+                    inventory_count = int(source_counts.get('inventory', 0))
+                    odoo_count = int(source_counts.get('odoo', 0))
+                    
+                    col1, col2, col3, col4,col5 = st.columns(5)
+                    
+                    with col1:
+                        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                        st.metric("Total Records", f"{len(result_df):,}")
+                        st.markdown('</div>', unsafe_allow_html=True)
+                    
+                    with col2:
+                        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                        st.metric("From Inventory", f"{inventory_count:,}")
+                        st.markdown('</div>', unsafe_allow_html=True)
+                    
+                    with col3:
+                        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                        st.metric("From ODOO", f"{odoo_count:,}")
+                        st.markdown('</div>', unsafe_allow_html=True)
+                    
+                    with col4:
+                        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                        st.metric("Total Discount", f"₹{total_discount:,.2f}")
+                        st.markdown('</div>', unsafe_allow_html=True)
+
+                    # And update the total value calculation to show net value
+                    with col5:  # Add a fifth column
+                        st.markdown('<div class="metric-card">', unsafe_allow_html=True)
+                        st.metric("Net Value", f"₹{net_value:,.2f}")
+                        st.markdown('</div>', unsafe_allow_html=True)
+                    
+                    # Download section
+                    st.markdown('<div class="sub-header">💾 Download Results</div>', unsafe_allow_html=True)
+                    
+                    # Serialize each download format at most once per result
+                    downloads = st.session_state['merger_downloads']
+                    if export_format not in downloads:
+                        if export_format == "csv":
+                            downloads[export_format] = result_df.to_csv(index=False).encode()
+                        else:
+                            downloads[export_format] = write_excel_fast(result_df, 'Combined_Results').getvalue()
+                    
+                    if export_format == "csv":
+                        st.download_button(
+                            label="📥 Download Combined CSV File",
+                            data=downloads[export_format],
+                            file_name="credit_note_data.csv",
+                            mime="text/csv",
                             use_container_width=True,
-                            hide_index=True,
-                            height=400
+                            key="download_combined_csv"
                         )
-                        
-                        # Summary statistics
-                        st.markdown('<div class="sub-header">📈 Summary Statistics</div>', unsafe_allow_html=True)
-                        
-                        col1, col2, col3, col4,col5 = st.columns(5)
-                        
-                        with col1:
-                            st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                            st.metric("Total Records", f"{len(result_df):,}")
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        with col2:
-                            st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                            inventory_count = len(result_df[result_df['source'] == 'inventory']) if 'inventory' in result_df['source'].values else 0
-                            st.metric("From Inventory", f"{inventory_count:,}")
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        with col3:
-                            st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                            odoo_count = len(result_df[result_df['source'] == 'odoo']) if 'odoo' in result_df['source'].values else 0
-                            st.metric("From ODOO", f"{odoo_count:,}")
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        with col4:
-                            st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                            total_discount = (result_df['unit_price'] * result_df['quantity'] * result_df['discount'] / 100).sum()
-                            st.metric("Total Discount", f"₹{total_discount:,.2f}")
-                            st.markdown('</div>', unsafe_allow_html=True)
-
-                        # And update the total value calculation to show net value
-                        with col5:  # Add a fifth column
-                            st.markdown('<div class="metric-card">', unsafe_allow_html=True)
-                            total_value = (result_df['unit_price'] * result_df['quantity']).sum()
-                            net_value = total_value - total_discount
-                            st.metric("Net Value", f"₹{net_value:,.2f}")
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        # Download section
-                        st.markdown('<div class="sub-header">💾 Download Results</div>', unsafe_allow_html=True)
-                        
-                        output = BytesIO()
-                        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                            result_df.to_excel(writer, index=False, sheet_name='Combined_Results')
-                        
-                        output.seek(0)
-                        
+                    else:
                         st.download_button(
                             label="📥 Download Combined Excel File",
-                            data=output,
+                            data=downloads[export_format],
                             file_name="credit_note_data.xlsx",
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                             use_container_width=True,
                             key="download_combined"
                         )
-                            
-                    except Exception as e:
-                        st.error(f"❌ Error processing files: {str(e)}")
+                
+                except Exception as e:
+                    st.error(f"❌ Error processing files: {str(e)}")
         
         else:
             st.info("📝 Please upload at least one file to begin processing.")
@@ -513,7 +819,7 @@ def main():
             st.header("📋 Instructions")
             st.info("""
             1. Connect to Odoo using the button below
-            2. Upload the combined Excel file
+            2. Upload the combined Excel or CSV file
             3. Click 'Process Odoo Integration'
             4. Review the results
             """)
@@ -525,11 +831,14 @@ def main():
                     st.error("❌ Odoo configuration not found in environment variables")
                 else:
                     with st.spinner("Connecting to Odoo..."):
-                        success, message = test_odoo_connection(config)
+                        success, message, uid = test_odoo_connection(config)
                         if success:
                             st.success(message)
                             st.session_state.odoo_connected = True
                             st.session_state.odoo_config = config
+                            # Keep the authenticated session so processing skips re-authentication
+                            st.session_state.odoo_uid = uid
+                            st.session_state.odoo_models = get_odoo_proxy(config, 'object')
                         else:
                             st.error(message)
                             st.session_state.odoo_connected = False
@@ -539,29 +848,46 @@ def main():
         
         st.markdown('<div class="sub-header">📤 Upload Combined File</div>', unsafe_allow_html=True)
         
-        uploaded_file = st.file_uploader(
-            "Upload the combined Excel file", 
-            type=['xlsx'],
-            key='combined_file'
-        )
+        use_last_processed = False
+        if 'combined_df' in st.session_state:
+            use_last_processed = st.checkbox(
+                f"Use last processed data (Records: {len(st.session_state.combined_df):,})",
+                key='use_last_processed'
+            )
         
-        if uploaded_file:
-            try:
-                preview_df = pd.read_excel(uploaded_file)
-                st.success(f"✅ Combined file uploaded! Records: {len(preview_df):,}")
-            except Exception as e:
-                st.error(f"❌ Error reading file: {str(e)}")
+        uploaded_file = None
+        if not use_last_processed:
+            uploaded_file = st.file_uploader(
+                "Upload the combined Excel or CSV file", 
+                type=['xlsx', 'csv'],
+                key='combined_file'
+            )
+            
+            if uploaded_file:
+                try:
+                    combined_rows = _session_cached(
+                        'combined_rows', _file_digest(uploaded_file.getvalue()),
+                        lambda: count_combined_rows(uploaded_file)
+                    )
+                    st.success(f"✅ Combined file uploaded! Records: {combined_rows:,}")
+                except Exception as e:
+                    st.error(f"❌ Error reading file: {str(e)}")
         
         if st.button("🚀 Process Odoo Integration", use_container_width=True, key="process_odoo"):
             if not st.session_state.get('odoo_connected', False):
                 st.error("❌ Please connect to Odoo first")
-            elif not uploaded_file:
-                st.error("❌ Please upload the combined Excel file")
+            elif not use_last_processed and not uploaded_file:
+                st.error("❌ Please upload the combined Excel or CSV file")
             else:
                 with st.spinner("🔄 Processing Odoo integration... This may take a while."):
                     try:
                         config = st.session_state.odoo_config
-                        results = process_odoo_integration(uploaded_file, config)
+                        uid = st.session_state.odoo_uid
+                        models = st.session_state.get('odoo_models')
+                        if use_last_processed:
+                            results = _process_df(st.session_state.combined_df, config, uid, models)
+                        else:
+                            results = process_odoo_integration(uploaded_file, config, uid, models)
                         
                         # Display results
                         st.markdown('<div class="sub-header">📋 Processing Results</div>', unsafe_allow_html=True)